@@ -1,7 +1,18 @@
-from fastapi import FastAPI, HTTPException, Query
+from collections import deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse, parse_qs, urlencode
+
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse
 from playwright.async_api import async_playwright
+import anyio
 import asyncio
+import hashlib
+import httpx
 import logging
+import os
+import sys
 
 # Configure logging
 logging.basicConfig(
@@ -10,154 +21,512 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Vidssave Session Generator API (GET)")
+BROWSER_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+]
 
+# When set (e.g. http://127.0.0.1:9222), attach to an externally managed
+# Chromium over CDP instead of launching one per worker, so HTTP worker
+# count no longer multiplies browser memory. Run the sidecar with
+# `chromium --headless=new --remote-debugging-port=9222`.
+BROWSER_CDP_URL = os.getenv("BROWSER_CDP_URL")
 
-def cookies_to_netscape(cookies):
-    lines = ["# Netscape HTTP Cookie File"]
-    for c in cookies:
-        lines.append(
-            "\t".join([
-                c["domain"],
-                "TRUE" if c["domain"].startswith(".") else "FALSE",
-                c["path"],
-                "TRUE" if c["secure"] else "FALSE",
-                str(c["expires"] or 0),
-                c["name"],
-                c["value"],
-            ])
+# Pool sizing: cap concurrent contexts so burst traffic can't OOM the host,
+# and recycle each context after a number of uses to bound memory growth.
+POOL_SIZE = 4
+MAX_REUSES = 25
+
+# Process-level backpressure: cap concurrent sessions doing real work and
+# shed load with a 429 once the queue wait exceeds the timeout.
+LIMITER = anyio.CapacityLimiter(int(os.getenv("MAX_CONCURRENCY", "4")))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "30"))
+
+# Parse results for a given video are stable for minutes, so repeat requests
+# can skip the browser entirely. Keyed on (video_id, quality).
+CACHE_TTL = 600
+RESULT_CACHE = TTLCache(maxsize=10_000, ttl=CACHE_TTL)
+
+# Single-flight map: concurrent requests for the same key await the first
+# request's future instead of running duplicate sessions.
+INFLIGHT = {}
+
+PARSE_API_URL = "https://api.vidssave.com/api/contentsite_api/media/parse"
+PARSE_PATH = "/media/parse"
+CACHE_MARKER = "origin=cache"
+
+# Only the parse XHR matters; everything cosmetic is dead weight for Chromium.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet", "other"}
+BLOCKED_DOMAINS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "googlesyndication.com",
+)
+
+
+async def block_nonessential(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    elif any(domain in req.url for domain in BLOCKED_DOMAINS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+# Last parse payload and cookies observed from a real browser session.
+# Once populated, new videos can be parsed with a direct httpx POST and
+# the browser is only needed again when the template goes stale.
+PARSE_TEMPLATE = {}
+
+
+def video_id_from_url(youtube_url):
+    """Extract the YouTube video id so cache keys ignore URL variations."""
+    parsed = urlparse(youtube_url)
+    if parsed.hostname and parsed.hostname.endswith("youtu.be"):
+        return parsed.path.lstrip("/") or youtube_url
+    v = parse_qs(parsed.query).get("v")
+    return v[0] if v else youtube_url
+
+
+class ContextPool:
+    """Bounded pool of reusable (BrowserContext, Page) pairs.
+
+    At most `max_size` contexts exist at a time; requests beyond that wait
+    on the semaphore. Each context keeps one long-lived page that is reset
+    to about:blank between leases, avoiding a target-creation round-trip
+    per request. Pairs are closed after `max_reuses` leases instead of
+    being returned to the free list, bounding Chromium heap growth.
+    """
+
+    def __init__(self, browser, max_size=POOL_SIZE, max_reuses=MAX_REUSES):
+        self._browser = browser
+        self._max_reuses = max_reuses
+        self._sem = asyncio.Semaphore(max_size)
+        self._free = deque()
+        self._uses = {}
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            while self._free:
+                context, page = self._free.popleft()
+                try:
+                    # Drop the previous request's DOM/JS state; cookies are
+                    # kept on purpose so warm Cloudflare clearance survives
+                    # reuse.
+                    await page.goto("about:blank")
+                    return context, page
+                except Exception:
+                    # Stale pair (crashed/restarted browser): discard it and
+                    # fall through to a fresh context instead of failing.
+                    logger.warning("Discarding pooled context that failed reset")
+                    self._uses.pop(context, None)
+                    try:
+                        await context.close()
+                    except Exception:
+                        pass
+            logger.debug("Creating new browser context for pool")
+            context = await self._browser.new_context()
+            # Installed once per context, not per page, so every lease
+            # benefits without re-registering the handler.
+            await context.route("**/*", block_nonessential)
+            page = await context.new_page()
+            self._uses[context] = 0
+            return context, page
+        except BaseException:
+            # Never leak the slot: a failure here would otherwise shrink
+            # the pool permanently.
+            self._sem.release()
+            raise
+
+    async def release(self, context, page, discard=False):
+        try:
+            self._uses[context] += 1
+            if discard or self._uses[context] >= self._max_reuses:
+                logger.debug("Recycling browser context after %d uses", self._uses[context])
+                self._uses.pop(context, None)
+                try:
+                    await context.close()
+                except Exception:
+                    # Closing a dead context must not mask the lease's
+                    # real outcome.
+                    logger.debug("Ignoring error closing browser context")
+            else:
+                self._free.append((context, page))
+        finally:
+            self._sem.release()
+
+    @asynccontextmanager
+    async def lease(self):
+        context, page = await self.acquire()
+        try:
+            yield context, page
+        except BaseException:
+            # The pair may be mid-navigation or attached to a dead target;
+            # close it rather than feed a broken page back to the pool.
+            await self.release(context, page, discard=True)
+            raise
+        else:
+            await self.release(context, page)
+
+    async def close(self):
+        while self._free:
+            context, _ = self._free.popleft()
+            await context.close()
+        self._uses.clear()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Launch Chromium once at startup and reuse it for every request;
+    # per-request work only leases a BrowserContext from the pool.
+    app.state.pw = await async_playwright().start()
+    if BROWSER_CDP_URL:
+        logger.info("Connecting to shared Chromium at %s", BROWSER_CDP_URL)
+        app.state.browser = await app.state.pw.chromium.connect_over_cdp(BROWSER_CDP_URL)
+    else:
+        logger.info("Starting Playwright and launching shared Chromium browser")
+        app.state.browser = await app.state.pw.chromium.launch(
+            headless=True,
+            args=BROWSER_ARGS,
+        )
+    app.state.pool = ContextPool(app.state.browser)
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        limits=httpx.Limits(max_connections=100),
+    )
+    logger.info("Shared browser ready")
+    yield
+    logger.info("Shutting down shared browser")
+    await app.state.http.aclose()
+    await app.state.pool.close()
+    await app.state.browser.close()
+    await app.state.pw.stop()
+
+
+app = FastAPI(
+    title="Vidssave Session Generator API (GET)",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+def find_download_url(resources, quality):
+    idx = {
+        (r.get("type"), r.get("format"), r.get("quality"), r.get("download_mode")): r
+        for r in resources
+    }
+    match = idx.get(("video", "MP4", quality, "direct"))
+    return match and match["download_url"]
+
+
+def build_parse_payload(template_payload, youtube_url):
+    """Substitute the requested video into a previously captured payload."""
+    params = parse_qs(template_payload, keep_blank_values=True)
+    params["url"] = [youtube_url]
+    return urlencode(params, doseq=True)
+
+
+async def try_fast_parse(youtube_url, quality, include_cookies):
+    """POST the parse payload directly with httpx, skipping the browser.
+
+    Returns the result dict, or None when no template has been captured yet
+    or the template looks stale (Cloudflare challenge, non-JSON body, empty
+    resources) so the caller falls back to the Playwright path.
+    """
+    if not PARSE_TEMPLATE:
+        return None
+    if include_cookies and PARSE_TEMPLATE.get("cookies") is None:
+        # Client wants cookies but the last browser run didn't extract any;
+        # only a fresh session can provide them.
+        return None
+
+    payload = build_parse_payload(PARSE_TEMPLATE["payload"], youtube_url)
+    try:
+        resp = await app.state.http.post(
+            PARSE_API_URL,
+            content=payload.encode(),
+            headers={
+                "content-type": "application/x-www-form-urlencoded",
+                "cookie": PARSE_TEMPLATE["cookie_header"],
+            },
         )
-    return "\n".join(lines)
+    except httpx.HTTPError as exc:
+        logger.warning("Fast parse request failed: %s", exc)
+        return None
+
+    if resp.status_code != 200:
+        logger.warning("Fast parse returned HTTP %d, falling back to browser", resp.status_code)
+        return None
+    try:
+        data = resp.json()
+    except ValueError:
+        logger.warning("Fast parse returned non-JSON body, falling back to browser")
+        return None
+
+    resources = data.get("data", {}).get("resources", [])
+    if not resources:
+        logger.warning("Fast parse returned no resources, falling back to browser")
+        return None
+
+    download_url = find_download_url(resources, quality)
+    if not download_url:
+        logger.error("Direct download URL not found for quality %s", quality)
+        raise HTTPException(404, "Direct download URL not found")
+
+    logger.debug("Fast parse succeeded, browser skipped")
+    result = {"download_url": download_url}
+    if include_cookies:
+        result["cookies"] = PARSE_TEMPLATE["cookies"]
+        result["cookies_netscape"] = PARSE_TEMPLATE["cookies_netscape"]
+    return result
+
+
+def cookies_to_netscape(cookies):
+    return "# Netscape HTTP Cookie File\n" + "\n".join(
+        f'{c["domain"]}\t{"TRUE" if c["domain"][:1] == "." else "FALSE"}\t'
+        f'{c["path"]}\t{"TRUE" if c["secure"] else "FALSE"}\t'
+        f'{int(c["expires"] or 0)}\t{c["name"]}\t{c["value"]}'
+        for c in cookies
+    )
+
+
+async def run_browser_session(youtube_url, quality, include_cookies):
+    """Drive a headless browser session and return the parse result dict."""
+    download_url = None
+    payload_future = asyncio.get_running_loop().create_future()
+
+    async with app.state.pool.lease() as (context, page):
+        logger.debug("Leased browser context and page")
+        cdp = None
+        try:
+            # Capture the origin=cache parse request over a raw CDP session;
+            # unlike page.on("request") this avoids a Python callback per
+            # page resource and only inspects the matching POST.
+            cdp = await context.new_cdp_session(page)
+
+            async def fetch_post_data(request_id):
+                try:
+                    res = await cdp.send(
+                        "Network.getRequestPostData", {"requestId": request_id}
+                    )
+                except Exception:
+                    return
+                body = res.get("postData", "")
+                if not payload_future.done() and CACHE_MARKER in body:
+                    logger.debug("Captured parse payload from request")
+                    payload_future.set_result(body)
+
+            def capture_request(params):
+                if payload_future.done():
+                    return
+                req = params.get("request", {})
+                if req.get("method") != "POST" or PARSE_PATH not in req.get("url", ""):
+                    return
+                body = req.get("postData")
+                if body is None:
+                    # Body was too large to inline in the event; fetch it.
+                    asyncio.ensure_future(fetch_post_data(params["requestId"]))
+                elif CACHE_MARKER in body:
+                    logger.debug("Captured parse payload from request")
+                    payload_future.set_result(body)
+
+            logger.debug("Setting up request interceptor")
+            cdp.on("Network.requestWillBeSent", capture_request)
+            await cdp.send("Network.enable")
+
+            # Open site and submit URL
+            logger.debug("Navigating to vidssave.com")
+            await page.goto("https://vidssave.com/", wait_until="commit", timeout=30000)
+            logger.debug("Navigation committed")
+
+            logger.debug("Waiting for input field")
+            await page.wait_for_selector("input", state="visible", timeout=30000)
+            logger.debug("Filling input field with URL: %s", youtube_url)
+            await page.fill("input", youtube_url)
+
+            logger.debug("Clicking submit button")
+            await page.locator("button:visible").first.click(timeout=5000)
+
+            logger.debug("Waiting for parse payload")
+            try:
+                parse_payload = await asyncio.wait_for(payload_future, timeout=15)
+            except asyncio.TimeoutError:
+                logger.error("Failed to capture parse payload")
+                raise HTTPException(500, "Failed to capture parse payload")
+
+            # Payload is in hand; stop paying for network events on any
+            # retries or late page traffic.
+            cdp.remove_listener("Network.requestWillBeSent", capture_request)
+            await cdp.send("Network.disable")
+
+            logger.debug("Parse payload captured successfully")
+
+            # Call parse API from Python with the session's cookies instead
+            # of round-tripping the payload through page.evaluate.
+            logger.debug("Calling parse API with captured payload")
+            api_cookies = await context.cookies("https://api.vidssave.com")
+
+            async def do_parse():
+                resp = await app.state.http.post(
+                    PARSE_API_URL,
+                    content=parse_payload.encode(),
+                    headers={
+                        "content-type": "application/x-www-form-urlencoded",
+                        "cookie": "; ".join(f'{c["name"]}={c["value"]}' for c in api_cookies),
+                    },
+                )
+                return resp.json()
+
+            # Cookie extraction doesn't depend on the parse response, so
+            # run the CDP round-trip concurrently with the HTTP call.
+            cookies_task = None
+            async with asyncio.TaskGroup() as tg:
+                parse_task = tg.create_task(do_parse())
+                if include_cookies:
+                    cookies_task = tg.create_task(context.cookies())
+            response = parse_task.result()
+            logger.debug("Parse API response received")
+
+            resources = response.get("data", {}).get("resources", [])
+            logger.debug("Found %d resources in response", len(resources))
+
+            logger.debug("Searching for video with quality: %s", quality)
+            download_url = find_download_url(resources, quality)
+
+            if not download_url:
+                logger.error("Direct download URL not found for quality %s", quality)
+                raise HTTPException(404, "Direct download URL not found")
+
+            logger.debug("Download URL found successfully")
+
+            cookies_json = cookies_netscape = None
+            if cookies_task is not None:
+                cookies_json = cookies_task.result()
+                logger.debug("Extracted %d cookies", len(cookies_json))
+
+                logger.debug("Converting cookies to Netscape format")
+                cookies_netscape = cookies_to_netscape(cookies_json)
+
+            # Refresh the fast-path template so the next request can POST
+            # the parse payload directly instead of driving a browser.
+            PARSE_TEMPLATE.update(
+                payload=parse_payload,
+                cookie_header="; ".join(f'{c["name"]}={c["value"]}' for c in api_cookies),
+                cookies=cookies_json,
+                cookies_netscape=cookies_netscape,
+            )
+        finally:
+            # The page returns to the pool, so only the CDP session needs
+            # tearing down here.
+            if cdp is not None:
+                logger.debug("Detaching CDP session")
+                try:
+                    await cdp.detach()
+                except Exception:
+                    pass
+
+    result = {"download_url": download_url}
+    if include_cookies:
+        result["cookies"] = cookies_json
+        result["cookies_netscape"] = cookies_netscape
+    return result
+
+
+async def resolve_session(key, youtube_url, quality, include_cookies):
+    """Do the real work for one cache key: queue, parse, populate cache."""
+    # Cache hits and coalesced duplicates skip the queue; only the leader
+    # doing real work competes for limiter slots.
+    try:
+        with anyio.fail_after(QUEUE_TIMEOUT):
+            await LIMITER.acquire()
+    except TimeoutError:
+        logger.warning("Concurrency limit queue timed out for %s", key)
+        raise HTTPException(429, "Server busy, try again later")
+    try:
+        result = await try_fast_parse(youtube_url, quality, include_cookies)
+        if result is None:
+            result = await run_browser_session(youtube_url, quality, include_cookies)
+        RESULT_CACHE[key] = result
+        return result
+    finally:
+        LIMITER.release()
+
+
+def _inflight_done(key):
+    def callback(task):
+        INFLIGHT.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # mark retrieved for the no-waiters case
+    return callback
 
 
 @app.get("/vidssave")
 async def generate_session(
+    response: Response,
     youtube_url: str = Query(..., description="YouTube video URL"),
     quality: str = Query("360P", description="Video quality e.g. 360P, 720P"),
+    include_cookies: bool = Query(False, description="Also return session cookies"),
 ):
-    logger.info(f"Starting session generation for URL: {youtube_url}, Quality: {quality}")
-    parse_payload = None
-    download_url = None
+    logger.info("Starting session generation for URL: %s, Quality: %s", youtube_url, quality)
+    key = (video_id_from_url(youtube_url), quality, include_cookies)
 
-    async with async_playwright() as p:
-        logger.info("Launching Chromium browser in headless mode")
-        browser = await p.chromium.launch(
-            headless=True,
-            args=[
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-            ],
-        )
-        logger.info("Browser launched successfully")
-
-        logger.info("Creating new browser context and page")
-        context = await browser.new_context()
-        page = await context.new_page()
-        logger.info("Browser context and page created")
-
-        # Capture origin=cache parse request
-        def capture_request(req):
-            nonlocal parse_payload
-            if "/media/parse" in req.url and req.method == "POST":
-                body = req.post_data or ""
-                if "origin=cache" in body:
-                    logger.info("Captured parse payload from request")
-                    parse_payload = req.post_data
-
-        logger.info("Setting up request interceptor")
-        page.on("request", capture_request)
-
-        # Open site and submit URL
-        logger.info("Navigating to vidssave.com")
-        await page.goto("https://vidssave.com/", timeout=60000)
-        logger.info("Page loaded successfully")
-        
-        logger.info("Waiting for input field")
-        await page.wait_for_selector("input", timeout=20000)
-        logger.info(f"Filling input field with URL: {youtube_url}")
-        await page.fill("input", youtube_url)
-
-        logger.info("Looking for submit button")
-        for btn in await page.locator("button").all():
-            if await btn.is_visible():
-                logger.info("Clicking submit button")
-                await btn.click()
-                break
-
-        logger.info("Waiting 6 seconds for response")
-        await asyncio.sleep(6)
-
-        if not parse_payload:
-            logger.error("Failed to capture parse payload")
-            await browser.close()
-            raise HTTPException(500, "Failed to capture parse payload")
-        
-        logger.info("Parse payload captured successfully")
-
-        # Call parse API inside SAME browser session
-        logger.info("Calling parse API with captured payload")
-        response = await page.evaluate(
-            """
-            async (payload) => {
-                const r = await fetch(
-                    "https://api.vidssave.com/api/contentsite_api/media/parse",
-                    {
-                        method: "POST",
-                        headers: {
-                            "content-type": "application/x-www-form-urlencoded"
-                        },
-                        body: payload
-                    }
-                );
-                return await r.json();
-            }
-            """,
-            parse_payload,
-        )
-        logger.info("Parse API response received")
-
-        resources = response.get("data", {}).get("resources", [])
-        logger.info(f"Found {len(resources)} resources in response")
-
-        logger.info(f"Searching for video with quality: {quality}")
-        for r in resources:
-            if (
-                r.get("type") == "video"
-                and r.get("format") == "MP4"
-                and r.get("quality") == quality
-                and r.get("download_mode") == "direct"
-            ):
-                download_url = r["download_url"]
-                logger.info(f"Found matching download URL for quality {quality}")
-                break
-
-        if not download_url:
-            logger.error(f"Direct download URL not found for quality {quality}")
-            await browser.close()
-            raise HTTPException(404, "Direct download URL not found")
-        
-        logger.info("Download URL found successfully")
-
-        logger.info("Extracting cookies from browser context")
-        cookies_json = await context.cookies()
-        logger.info(f"Extracted {len(cookies_json)} cookies")
-        
-        logger.info("Converting cookies to Netscape format")
-        cookies_netscape = cookies_to_netscape(cookies_json)
-
-        logger.info("Closing browser")
-        await browser.close()
-        logger.info("Browser closed successfully")
+    result = RESULT_CACHE.get(key)
+    if result is None:
+        task = INFLIGHT.get(key)
+        if task is None:
+            task = asyncio.create_task(
+                resolve_session(key, youtube_url, quality, include_cookies)
+            )
+            INFLIGHT[key] = task
+            task.add_done_callback(_inflight_done(key))
+        else:
+            # Someone is already doing this exact work; share their result
+            # (or their failure) without taking a limiter slot.
+            logger.debug("Joining in-flight request for %s", key)
+        # Shielded so one disconnecting client can't cancel work that
+        # coalesced requests are still waiting on.
+        result = await asyncio.shield(task)
+    else:
+        logger.debug("Cache hit for %s", key)
 
+    response.headers["Cache-Control"] = f"public, max-age={CACHE_TTL}"
+    response.headers["ETag"] = hashlib.md5(result["download_url"].encode()).hexdigest()
     logger.info("Session generation completed successfully")
-    return {
-        "download_url": download_url,
-        "cookies": cookies_json,
-        "cookies_netscape": cookies_netscape
-    }
+    return result
+
+
+def pick_event_loop():
+    """Choose the cheapest event loop implementation available.
+
+    uvloop (libuv-based) when importable; uvloop builds with the
+    experimental io_uring backend are picked up the same way on kernels
+    that support it (5.6+), batching socket syscalls. Otherwise fall back
+    to uvicorn's auto-detection.
+    """
+    if sys.platform != "linux":
+        return "auto"
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return "auto"
+    return "uvloop"
+
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app)
+    # One worker per core; each worker runs its own lifespan, so the
+    # browser, ContextPool, caches and fast-path template are per-process.
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count(),
+        loop=pick_event_loop(),
+        http="httptools",
+        log_level="warning",
+    )